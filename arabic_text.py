@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+# تطبيع النص العربي، مشترك بين main.py و medical_bot_complete.py عشان مفاتيح الكاش متختلفش بين الاتنين
+
+# توحيد الكتابة العربي (ألف/همزة، ى، تطويل، تشكيل) في pass واحد بـ translate بدل replace ورا replace
+ARABIC_NORMALIZE = str.maketrans(
+    {"ـ": "", "أ": "ا", "إ": "ا", "آ": "ا", "ى": "ي", "ؤ": "و", "ئ": "ي"}
+    | dict.fromkeys("\u064b\u064c\u064d\u064e\u064f\u0650\u0651\u0652", "")
+)
+
+
+def normalize_arabic(text: str) -> str:
+    return text.translate(ARABIC_NORMALIZE)
+
+
+def normalize_query(text: str) -> str:
+    # شكل السؤال في مفتاح الكاش: حروف موحدة، مسافات موحدة، lowercase
+    return " ".join(normalize_arabic(text).split()).lower()
@@ -2,32 +2,56 @@
 # -*- coding: utf-8 -*-
 
 import os
+import atexit
+import re
 import sys
+import asyncio
+import functools
+import queue
+import random
+import hashlib
+import math
 import sqlite3
 import logging
+import threading
+import time
+import weakref
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 from pathlib import Path
 
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.error import TelegramError
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler,
-    ConversationHandler, filters, ContextTypes
+    AIORateLimiter, Application, CommandHandler, MessageHandler,
+    filters, ContextTypes
 )
 import httpx
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 
+from arabic_text import normalize_arabic, normalize_query
+
 # ─── Logging ─────────────────────────────────────────────────────────────────
 logs_dir = Path("logs")
 logs_dir.mkdir(exist_ok=True)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - [%(funcName)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.FileHandler(logs_dir / 'medical_bot.log'),
-        logging.StreamHandler()
-    ]
-)
+_log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - [%(funcName)s:%(lineno)d] - %(message)s')
+_log_handlers = [logging.FileHandler(logs_dir / 'medical_bot.log'), logging.StreamHandler()]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+# الكتابة على الملف/الشاشة بتحصل في thread منفصل، والـ event loop بيعمل queue.put بس
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_listener = QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
+_root_logger = logging.getLogger()
+_root_logger.setLevel(logging.INFO)
+_root_logger.addHandler(QueueHandler(_log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # ─── Load ENV ─────────────────────────────────────────────────────────────────
@@ -39,6 +63,13 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 GROQ_API_KEY   = os.getenv("GROQ_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 ADMIN_ID       = os.getenv("ADMIN_ID")
+# لو متحدد، البوت بيشتغل webhook بدل polling (مثال: https://bot.example.com)
+WEBHOOK_URL    = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT   = int(os.getenv("PORT", "8443"))
+# Telegram بيبعته في هيدر X-Telegram-Bot-Api-Secret-Token، وPTB بيرفض أي طلب من غيره
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# عدد الاتصالات اللي Telegram بيفتحها على الـ webhook بالتوازي
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
 
 if not TELEGRAM_TOKEN:
     logger.error("TELEGRAM_TOKEN غير موجود!")
@@ -47,6 +78,46 @@ if not TELEGRAM_TOKEN:
 # ─── Constants ────────────────────────────────────────────────────────────────
 GROQ_API_URL   = "https://api.groq.com/openai/v1/chat/completions"
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:streamGenerateContent?alt=sse"
+GEMINI_EMBED_URL  = "https://generativelanguage.googleapis.com/v1beta/models/text-embedding-004:batchEmbedContents"
+GROQ_MODEL     = "llama-3.3-70b-versatile"
+GEMINI_MODEL   = "gemini-1.5-flash"
+EMBED_MODEL    = "models/text-embedding-004"
+# الـ embedding اللي قبل الرد (الكاش) ليه مهلة قصيرة ومن غير retries، ولو اتأخر بنعتبره miss
+EMBED_LOOKUP_TIMEOUT = 0.3
+TELEGRAM_MAX_LEN = 4000
+# أقل وقت بين تعديلين لرسالة الرد أثناء الـ streaming (حدود Telegram)
+STREAM_EDIT_INTERVAL = 1.0
+# وقت الرد بيزيد مع عدد الـ tokens: حد للرد، وحد لطول سؤال المستخدم اللي بيتبعت للـ API
+GROQ_MAX_TOKENS   = 400
+GEMINI_MAX_TOKENS = 600
+MAX_QUERY_CHARS   = 2000
+
+# الهيدرز ثابتة، بتتبني مرة واحدة بدل كل طلب
+# مفتاح Gemini في هيدر مش في الـ URL، فالـ URL ثابت ومبيظهرش في الـ logs
+GROQ_HEADERS   = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
+GEMINI_HEADERS = {"x-goog-api-key": GEMINI_API_KEY or "", "Content-Type": "application/json"}
+
+# كل كام رسالة محادثة بنلخص اللي فات ونحفظه مع المريض، وسجل المحادثات بيتمسح بعد كام يوم
+SUMMARY_EVERY_TURNS = 10
+CHAT_RETENTION_DAYS = 180
+# كل قد إيه بنمسح السجل القديم (بالثواني)، مع الـ WAL checkpoint
+CHAT_PRUNE_INTERVAL = 24 * 3600
+
+# أسئلة المريض القديمة اللي شبه سؤاله الحالي (embeddings) بتتبعت مع الطلب بدل السجل كله
+HISTORY_TOP_K     = 5
+HISTORY_SCAN_ROWS = 200
+HISTORY_MIN_SCORE = 0.6
+
+# عدد الحجوزات في كل صفحة من /bookings
+BOOKINGS_PAGE_SIZE = 500
+
+# كتابة سجل المحادثات على دفعات
+CHAT_BATCH_SIZE     = 100
+CHAT_FLUSH_INTERVAL = 0.5
+
+# كل قد إيه نفضّي ملفات الـ WAL في الـ DB (بالثواني)
+WAL_CHECKPOINT_INTERVAL = 300
 
 CLINIC = {
     "doctor":  "د. أحمد سمير عبدالحميد",
@@ -56,6 +127,29 @@ CLINIC = {
     "days":    "السبت والثلاثاء والأحد"
 }
 
+# النصوص الثابتة بتتبني مرة واحدة، والـ handler بيضيف الاسم بس
+CLINIC_CONTACT = f"📍 {CLINIC['address']}\n📞 {CLINIC['phone']}\n🗓 {CLINIC['days']}"
+WELCOME_TEXT = (
+    f"أنا حكيم، المساعد الذكي لعيادة {CLINIC['doctor']}\n"
+    f"متخصص في {CLINIC['spec']} 🩺\n\n"
+    f"{CLINIC_CONTACT}\n\n"
+    "اسألني أي سؤال أو اختار من القائمة:"
+)
+HELP_TEXT = (
+    "📋 إيه اللي أقدر أعمله:\n\n"
+    "📅 حجز موعد - احجز في العيادة\n"
+    "💬 محادثة AI - اسأل أي سؤال طبي\n"
+    "🔬 تحليل طبي - تحليل عميق بـ Gemini\n"
+    "👤 ملفي - بياناتك المحفوظة\n\n"
+    f"{CLINIC_CONTACT}"
+)
+BOOKED_TEXT = (
+    "سيتواصل معك فريق العيادة لتأكيد الوقت.\n\n"
+    f"📞 {CLINIC['phone']}\n"
+    f"📍 {CLINIC['address']}\n"
+    f"🗓 {CLINIC['days']}"
+)
+
 # States
 (
     BOOKING_NAME,
@@ -65,95 +159,617 @@ CLINIC = {
     CHAT_MODE,
     CHAT_INPUT,
 ) = range(6)
+END = -1
+BOOKING_STATES = frozenset({BOOKING_NAME, BOOKING_PHONE, BOOKING_DAY, BOOKING_CONFIRM})
 
-# ─── Main Keyboard ─────────────────────────────────────────────────────────────
+# ─── Keyboards ────────────────────────────────────────────────────────────────
 MAIN_KEYBOARD = ReplyKeyboardMarkup(
     [["📅 حجز موعد"], ["💬 محادثة ذكاء اصطناعي", "🔬 تحليل طبي"], ["👤 ملفي الشخصي", "❓ مساعدة"]],
     resize_keyboard=True
 )
+DAY_KEYBOARD = ReplyKeyboardMarkup(
+    [["السبت", "الثلاثاء", "الأحد"]], resize_keyboard=True, one_time_keyboard=True
+)
+CONFIRM_KEYBOARD = ReplyKeyboardMarkup(
+    [["✅ تأكيد الحجز", "❌ تعديل"]], resize_keyboard=True, one_time_keyboard=True
+)
+CHAT_MODE_KEYBOARD = ReplyKeyboardMarkup(
+    [["🤖 Groq - سريع", "🧠 Gemini - تحليل عميق"], ["🏠 رجوع"]], resize_keyboard=True
+)
+BACK_KEYBOARD = ReplyKeyboardMarkup([["🏠 رجوع"]], resize_keyboard=True)
+
+# ─── Text Patterns ────────────────────────────────────────────────────────────
+# بنعمل compile مرة واحدة بدل ما نلف على list كلمات مع كل رسالة
+CONFIRM_RE = re.compile(
+    r"✅|أيوه|ايوه|اه|آه|أه|نعم|يلا|اكد|أكد|تأكيد|تمام|صح|موافق|وافق|ok|okay|yes",
+    re.IGNORECASE
+)
+CANCEL_RE = re.compile(r"❌|لأ|لا|الغ|إلغاء|cancel|مش عايز|مش عاوز", re.IGNORECASE)
+MENU_RE   = re.compile(r"🏠|الرئيسية|رجوع|القائمة")
+EXIT_RE   = re.compile(r"🏠|الرئيسية|رجوع|القائمة|خروج")
+PHONE_SEPARATORS_RE = re.compile(r"[ -]+")
+NON_DIGITS_RE       = re.compile(r"\D+")
+
+# الكلمات اللي بتفتح الحجز: جمل لو موجودة في أي حتة في الرسالة، وكلمات لازم تكون الرسالة كلها
+BOOKING_PHRASES = (
+    "📅 حجز موعد",
+    "عايز احجز", "عاوز احجز", "محتاج احجز", "محتاجه احجز",
+    "أريد حجز", "اريد حجز", "ابي احجز", "بدي احجز",
+    "عايز اعمل حجز", "عاوز اعمل حجز",
+    "حجزلي", "حجزني", "احجزلي", "احجزني",
+    "موعد كشف", "عايز موعد", "عاوز موعد", "محتاج موعد",
+)
+BOOKING_EXACT = frozenset({"احجز", "حجز"})
+# الجمل متوحدة زي الرسالة، فـ "أريد" و "اريد" (و "إحجزلي") بيطابقوا نفس الجملة
+BOOKING_PHRASES_RE = re.compile(
+    "|".join(map(re.escape, dict.fromkeys(map(normalize_arabic, BOOKING_PHRASES))))
+)
+
+
+class BookingTriggerFilter(filters.MessageFilter):
+    # set lookup للكلمات المطابقة + regex واحد للجمل، بدل alternation فيها anchors
+    def filter(self, message) -> bool:
+        text = message.text
+        if not text:
+            return False
+        text = normalize_arabic(text)
+        return text in BOOKING_EXACT or BOOKING_PHRASES_RE.search(text) is not None
+
+
+BOOKING_TRIGGER = BookingTriggerFilter()
+
+# زراير المحادثة بتتبعت كنص ثابت، فيكفي set lookup
+CHAT_BUTTONS = frozenset({"💬 محادثة ذكاء اصطناعي", "🔬 تحليل طبي"})
 
 # ─── Database ─────────────────────────────────────────────────────────────────
+# الاستعلامات المتكررة نصها ثابت، فالـ statement cache بتاع sqlite3 بيلاقيها مترجمة جاهزة
+SQL_PATIENT_EXISTS = 'SELECT 1 FROM patients WHERE telegram_id = ?'
+SQL_PATIENT_BY_TG  = '''SELECT id, telegram_id, name, phone, appointment_day, summary, created_at
+    FROM patients WHERE telegram_id = ?'''
+SQL_UPSERT_PATIENT = '''INSERT INTO patients
+    (telegram_id, name, phone, appointment_day, updated_at)
+    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(telegram_id) DO UPDATE SET
+        name = excluded.name,
+        phone = excluded.phone,
+        appointment_day = COALESCE(NULLIF(excluded.appointment_day, ''), appointment_day),
+        updated_at = CURRENT_TIMESTAMP'''
+# الملخص مبيغيرش updated_at، عشان updated_at = آخر حجز و/bookings بيرتب بيه
+SQL_UPDATE_SUMMARY = 'UPDATE patients SET summary = ? WHERE telegram_id = ?'
+SQL_INSERT_CHAT    = (
+    'INSERT INTO chat_history (telegram_id, message, response, api_used, embedding) VALUES (?, ?, ?, ?, ?)'
+)
+
+
 class PatientDatabase:
-    def __init__(self, db_path: str = "patients.db"):
+    def __init__(self, db_path: str = "patients.db", history_path: Optional[str] = None, pool_size: int = 4):
         self.db_path = db_path
+        # سجل المحادثات في ملف لوحده: كتابته كتير، فبياخد WAL و write lock منفصلين عن المرضى
+        self.history_path = history_path or str(Path(db_path).with_name("chat_history.db"))
+        # اتصال واحد للكتابة لكل ملف (محمي بـ lock) + pool للقراءة، بدل فتح اتصال جديد في كل request
+        self._write_lock = threading.Lock()
+        self._writer = self._connect(self.db_path)
+        self._history_lock = threading.Lock()
+        self._history_writer = self._connect(self.history_path)
+        # WAL بيتسجل في ملف الـ DB نفسه، فيكفي نفعّله مرة واحدة من اتصال الكتابة
+        for path, conn in ((self.db_path, self._writer), (self.history_path, self._history_writer)):
+            mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            if mode.lower() != "wal":
+                logger.warning("SQLite journal_mode of %s is %s, not WAL", path, mode)
+        # اتصالات القراءة بتعمل ATTACH لملف السجل عشان related_chats تقرا منه (history.chat_history)
+        self._pool: queue.Queue = queue.Queue(maxsize=pool_size)
+        for _ in range(pool_size):
+            conn = self._connect(self.db_path)
+            conn.execute("ATTACH DATABASE ? AS history", (self.history_path,))
+            self._pool.put(conn)
+        # LRU cache لـ get_patient: telegram_id -> (وقت التخزين، بيانات المريض)
+        self._patient_cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # عدد المرضى بيتحسب مرة واحدة وبعدين بيتحدث مع كل مريض جديد
+        self._count: Optional[int] = None
         self._init()
 
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, cached_statements=128)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-8000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=67108864")
+        # لو اتصال تاني ماسك الـ lock (checkpoint مثلاً) بنستنى بدل "database is locked" على طول
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _conn(self):
+        conn = self._pool.get(timeout=30)
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def _write(self):
+        with self._write_lock:
+            yield self._writer
+
+    @contextmanager
+    def _history(self):
+        with self._history_lock:
+            yield self._history_writer
+
+    def close(self):
+        # بيقفل اتصالات الكتابة واتصالات الـ pool (بعد ما الـ writer يخلص)
+        for lock, conn in ((self._write_lock, self._writer), (self._history_lock, self._history_writer)):
+            with lock:
+                # بيحدث إحصائيات الـ query planner للجداول اللي اتغيرت، ومش بيعمل حاجة لو مفيش داعي
+                try:
+                    conn.execute("PRAGMA optimize")
+                except sqlite3.Error as e:
+                    logger.warning("PRAGMA optimize failed: %s", e)
+                conn.close()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    PATIENT_CACHE_SIZE = 4096
+    PATIENT_CACHE_TTL  = 300
+
+    def _cache_get(self, telegram_id):
+        with self._cache_lock:
+            entry = self._patient_cache.get(telegram_id)
+            if entry is None:
+                return False, None
+            stored_at, patient = entry
+            if time.monotonic() - stored_at > self.PATIENT_CACHE_TTL:
+                del self._patient_cache[telegram_id]
+                return False, None
+            self._patient_cache.move_to_end(telegram_id)
+            return True, patient
+
+    def _cache_put(self, telegram_id, patient):
+        with self._cache_lock:
+            self._patient_cache[telegram_id] = (time.monotonic(), patient)
+            self._patient_cache.move_to_end(telegram_id)
+            if len(self._patient_cache) > self.PATIENT_CACHE_SIZE:
+                self._patient_cache.popitem(last=False)
+
+    @staticmethod
+    def _add_missing_column(conn, table, column, decl):
+        # الـ DBs القديمة اتعملت قبل العمود ده
+        columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
     def _init(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._write() as conn:
             conn.execute('''CREATE TABLE IF NOT EXISTS patients (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 telegram_id INTEGER UNIQUE,
                 name TEXT NOT NULL,
                 phone TEXT NOT NULL,
                 appointment_day TEXT,
+                summary TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )''')
+            self._add_missing_column(conn, 'patients', 'summary', 'TEXT')
+            # patients.telegram_id عليه UNIQUE فمتفهرس أصلاً
+            # iter_patients بيرتب بـ updated_at DESC (آخر حجز، الـ upsert بيسيب created_at زي ما هو)، الفهرس بيوفر الـ sort
+            conn.execute('DROP INDEX IF EXISTS idx_patients_created')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_patients_updated ON patients(updated_at DESC)'
+            )
+            legacy_history = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_history'"
+            ).fetchone() is not None
+        with self._history() as conn:
             conn.execute('''CREATE TABLE IF NOT EXISTS chat_history (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 telegram_id INTEGER,
                 message TEXT,
                 response TEXT,
                 api_used TEXT,
+                embedding BLOB,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )''')
-            conn.commit()
+            self._add_missing_column(conn, 'chat_history', 'embedding', 'BLOB')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_chat_tg_time ON chat_history(telegram_id, created_at DESC)'
+            )
+        if legacy_history and self.history_path != self.db_path:
+            self._migrate_history()
         logger.info("✓ Database initialized")
 
+    def _migrate_history(self):
+        # نسخ سجل المحادثات القديم من patients.db لملفه الجديد مرة واحدة، وبعدين مسح الجدول القديم
+        with self._write_lock, self._history_lock:
+            conn = self._history_writer
+            conn.execute("ATTACH DATABASE ? AS legacy", (self.db_path,))
+            try:
+                columns = {row['name'] for row in conn.execute('PRAGMA legacy.table_info(chat_history)')}
+                embedding = 'embedding' if 'embedding' in columns else 'NULL'
+                conn.execute('BEGIN')
+                moved = conn.execute(
+                    'INSERT INTO main.chat_history (telegram_id, message, response, api_used, embedding, created_at) '
+                    f'SELECT telegram_id, message, response, api_used, {embedding}, created_at FROM legacy.chat_history'
+                ).rowcount
+                conn.execute('DROP TABLE legacy.chat_history')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            finally:
+                conn.execute("DETACH DATABASE legacy")
+        logger.info("Moved %d chat rows to %s", moved, self.history_path)
+
     def save_patient(self, telegram_id, name, phone, day):
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute('''INSERT OR REPLACE INTO patients
-                    (telegram_id, name, phone, appointment_day, updated_at)
-                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)''',
-                    (telegram_id, name, phone, day))
-                conn.commit()
+            with self._write() as conn:
+                existed = conn.execute(SQL_PATIENT_EXISTS, (telegram_id,)).fetchone() is not None
+                # upsert بيعدل الصف في مكانه بدل delete + insert بتاع OR REPLACE
+                conn.execute(SQL_UPSERT_PATIENT, (telegram_id, name, phone, day))
+                if not existed and self._count is not None:
+                    self._count += 1
+                # بنحدث الكاش بالصف الجديد بدل ما نمسحه، عشان أول get_patient بعد الحجز ميروحش للـ DB
+                row = conn.execute(SQL_PATIENT_BY_TG, (telegram_id,)).fetchone()
+                self._cache_put(telegram_id, dict(row) if row else None)
             return True
         except Exception as e:
-            logger.error(f"save_patient error: {e}")
+            logger.error("save_patient error: %s", e)
             return False
 
     def get_patient(self, telegram_id):
+        hit, patient = self._cache_get(telegram_id)
+        if hit:
+            return patient
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                row = conn.execute(
-                    'SELECT * FROM patients WHERE telegram_id = ?', (telegram_id,)
-                ).fetchone()
-            if row:
-                return {'id': row[0], 'telegram_id': row[1], 'name': row[2],
-                        'phone': row[3], 'appointment_day': row[4], 'created_at': row[5]}
-            return None
+            with self._conn() as conn:
+                row = conn.execute(SQL_PATIENT_BY_TG, (telegram_id,)).fetchone()
+            patient = dict(row) if row else None
+            self._cache_put(telegram_id, patient)
+            return patient
         except Exception as e:
-            logger.error(f"get_patient error: {e}")
+            logger.error("get_patient error: %s", e)
             return None
 
-    def get_all_patients(self):
+    def save_summary(self, telegram_id, summary):
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                return conn.execute(
-                    'SELECT name, phone, appointment_day, created_at FROM patients ORDER BY created_at DESC'
-                ).fetchall()
+            with self._write() as conn:
+                conn.execute(SQL_UPDATE_SUMMARY, (summary, telegram_id))
+                row = conn.execute(SQL_PATIENT_BY_TG, (telegram_id,)).fetchone()
+                self._cache_put(telegram_id, dict(row) if row else None)
+            return True
         except Exception as e:
-            logger.error(f"get_all_patients error: {e}")
-            return []
+            logger.error("save_summary error: %s", e)
+            return False
+
+    def iter_patients(self, limit: int = -1, offset: int = 0, page_size: int = 100):
+        # بيرجع الحجوزات صفحة صفحة (fetchmany) بدل ما يحمل الجدول كله في الذاكرة
+        # limit = -1 معناها من غير حد في SQLite
+        try:
+            with self._conn() as conn:
+                cursor = conn.execute(
+                    'SELECT name, phone, appointment_day, updated_at FROM patients '
+                    'ORDER BY updated_at DESC LIMIT ? OFFSET ?',
+                    (limit, offset)
+                )
+                while True:
+                    page = cursor.fetchmany(page_size)
+                    if not page:
+                        break
+                    yield page
+        except Exception as e:
+            logger.error("iter_patients error: %s", e)
+
+    def db_size_bytes(self):
+        # من هيدر SQLite نفسه بدل stat() على الملف، للملفين مع بعض
+        try:
+            with self._conn() as conn:
+                total = 0
+                for schema in ('main', 'history'):
+                    page_count = conn.execute(f'PRAGMA {schema}.page_count').fetchone()[0]
+                    page_size = conn.execute(f'PRAGMA {schema}.page_size').fetchone()[0]
+                    total += page_count * page_size
+                return total
+        except Exception as e:
+            logger.error("db_size error: %s", e)
+            return 0
 
     def count(self):
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                return conn.execute('SELECT COUNT(*) FROM patients').fetchone()[0]
+            with self._write() as conn:
+                if self._count is None:
+                    self._count = conn.execute('SELECT COUNT(*) FROM patients').fetchone()[0]
+                return self._count
         except:
             return 0
 
-    def save_chat(self, telegram_id, message, response, api_used):
+    def save_chats(self, rows):
+        # rows: [(telegram_id, message, response, api_used, embedding), ...] في transaction واحدة
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute(
-                    'INSERT INTO chat_history (telegram_id, message, response, api_used) VALUES (?, ?, ?, ?)',
-                    (telegram_id, message, response, api_used)
-                )
-                conn.commit()
+            with self._history() as conn:
+                conn.execute('BEGIN')
+                try:
+                    conn.executemany(SQL_INSERT_CHAT, rows)
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+        except Exception as e:
+            logger.error("save_chats error (%d rows): %s", len(rows), e)
+
+    def related_chats(self, telegram_id, query: bytes, k: int = HISTORY_TOP_K, scan: int = HISTORY_SCAN_ROWS):
+        # أقرب k أسئلة من آخر scan رسالة للمريض؛ الـ vectors متخزنة normalized فالـ cosine = dot product
+        try:
+            with self._conn() as conn:
+                rows = conn.execute(
+                    'SELECT id, message, response, embedding FROM history.chat_history '
+                    'WHERE telegram_id = ? AND embedding IS NOT NULL ORDER BY created_at DESC LIMIT ?',
+                    (telegram_id, scan)
+                ).fetchall()
+        except Exception as e:
+            logger.error("related_chats error: %s", e)
+            return []
+        q = np.frombuffer(query, dtype=np.float32)
+        rows = [row for row in rows if len(row[3]) == len(query)]
+        if not rows:
+            return []
+        # كل الـ vectors في matrix واحدة ودot product واحد في numpy بدل loop بايثون
+        scores = np.frombuffer(b"".join(row[3] for row in rows), dtype=np.float32).reshape(len(rows), -1) @ q
+        best = [i for i in np.argsort(-scores)[:k] if scores[i] >= HISTORY_MIN_SCORE]
+        # بنرتبهم بالـ id مش بالـ score، عشان نفس المجموعة تطلع نفس النص بالظبط (prompt caching)
+        top = sorted((rows[i] for i in best), key=lambda row: row[0])
+        return [(message, response) for _, message, response, _ in top]
+
+    def prune_chats(self, days: int = CHAT_RETENTION_DAYS):
+        try:
+            with self._history() as conn:
+                deleted = conn.execute(
+                    "DELETE FROM chat_history WHERE created_at < datetime('now', ?)", (f'-{days} days',)
+                ).rowcount
+            if deleted:
+                logger.info("Pruned %d chat rows older than %d days", deleted, days)
         except Exception as e:
-            logger.error(f"save_chat error: {e}")
+            logger.error("prune_chats error: %s", e)
+
+    def checkpoint(self):
+        # TRUNCATE بيرجّع ملف الـ -wal لصفر بدل ما يفضل يكبر مع كتابة السجل
+        for path, lock, conn in (
+            (self.db_path, self._write_lock, self._writer),
+            (self.history_path, self._history_lock, self._history_writer),
+        ):
+            try:
+                with lock:
+                    busy, log, done = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+                logger.info("WAL checkpoint %s: busy=%d log=%d checkpointed=%d", path, busy, log, done)
+            except Exception as e:
+                logger.error("checkpoint error (%s): %s", path, e)
+
+
+# ─── HTTP Client ──────────────────────────────────────────────────────────────
+# client واحد مشترك لـ Groq و Gemini عشان نعيد استخدام اتصالات TLS (keep-alive + HTTP/2)
+HTTP = httpx.AsyncClient(
+    http2=True,
+    # الـ connect قصير: لو الـ API مش بيرد خالص بنعرف في 3 ثواني ونروح للتاني
+    timeout=httpx.Timeout(connect=3.0, read=25.0, write=5.0, pool=5.0),
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=300),
+)
+
+# حد أقصى للطلبات المتوازية + عدد الطلبات في الدقيقة لكل API، عشان الزحمة متتحولش لـ 429
+GROQ_CONCURRENCY   = 10
+GROQ_PER_MINUTE    = 500
+GEMINI_CONCURRENCY = 10
+GEMINI_PER_MINUTE  = 1000
+
+
+class ApiLimiter:
+    # semaphore للتوازي + token bucket للمعدل؛ بيتستخدم كـ async with حوالين كل طلب
+    def __init__(self, concurrency: int, per_minute: int):
+        self._sem = asyncio.Semaphore(concurrency)
+        self._capacity = float(per_minute)
+        self._rate = per_minute / 60.0
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self._sem.acquire()
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        break
+                    await asyncio.sleep((1 - self._tokens) / self._rate)
+        except BaseException:
+            self._sem.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self._sem.release()
+
+
+GROQ_LIMITER   = ApiLimiter(GROQ_CONCURRENCY, GROQ_PER_MINUTE)
+GEMINI_LIMITER = ApiLimiter(GEMINI_CONCURRENCY, GEMINI_PER_MINUTE)
+
+# الأخطاء المؤقتة (شبكة، 429، 5xx) بتتعاد بـ exponential backoff + jitter بدل ما توصل للمستخدم
+RETRY_ATTEMPTS   = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY  = 5.0
+RETRY_STATUSES   = frozenset({429, 500, 502, 503, 504})
+
+
+def _retry_delay(attempt: int, response: Optional[httpx.Response] = None) -> float:
+    # لو السيرفر بعت Retry-After بنلتزم بيه (بحد أقصى RETRY_MAX_DELAY)
+    if response is not None:
+        try:
+            return min(float(response.headers["Retry-After"]), RETRY_MAX_DELAY)
+        except (KeyError, ValueError):
+            pass
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+async def _post(url: str, headers: dict, body: dict, limiter: ApiLimiter,
+                attempts: int = RETRY_ATTEMPTS) -> httpx.Response:
+    content = orjson.dumps(body)
+    for attempt in range(attempts):
+        last = attempt == attempts - 1
+        try:
+            async with limiter:
+                r = await HTTP.post(url, headers=headers, content=content)
+        except httpx.TransportError as e:
+            # connect timeout يعني الـ API واقع، وread timeout يعني الرد خد مهلته كلها (25 ثانية)؛
+            # في الحالتين الـ retry بيضيع وقت والـ fallback أحسن
+            if last or isinstance(e, (httpx.ConnectTimeout, httpx.ReadTimeout)):
+                raise
+            delay = _retry_delay(attempt)
+            logger.warning("HTTP %s, retry %d in %.1fs", type(e).__name__, attempt + 1, delay)
+        else:
+            if r.status_code not in RETRY_STATUSES or last:
+                r.raise_for_status()
+                return r
+            delay = _retry_delay(attempt, r)
+            logger.warning("HTTP %d, retry %d in %.1fs", r.status_code, attempt + 1, delay)
+        await asyncio.sleep(delay)
+
+
+# ─── Embeddings ───────────────────────────────────────────────────────────────
+def _pack_vector(values) -> bytes:
+    # float32 normalized، عشان المقارنة بعد كده تبقى dot product بس
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return array('f', (v / norm for v in values)).tobytes()
+
+
+async def gemini_embed(texts: list, attempts: int = RETRY_ATTEMPTS) -> Optional[list]:
+    # embedding لكل النصوص في طلب واحد (batchEmbedContents)
+    if not GEMINI_API_KEY or not texts:
+        return None
+    try:
+        r = await _post(GEMINI_EMBED_URL, GEMINI_HEADERS, {
+            "requests": [{"model": EMBED_MODEL, "content": {"parts": [{"text": t}]}} for t in texts]
+        }, GEMINI_LIMITER, attempts)
+        return [_pack_vector(e['values']) for e in orjson.loads(r.content)['embeddings']]
+    except Exception as e:
+        logger.error("Gemini embed error: %s", e)
+        return None
+
+
+async def embed_query(text: str) -> Optional[bytes]:
+    # للطريق اللي المستخدم مستني فيه: محاولة واحدة في حدود EMBED_LOOKUP_TIMEOUT، وإلا None
+    try:
+        vectors = await asyncio.wait_for(gemini_embed([text], attempts=1), EMBED_LOOKUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    return vectors[0] if vectors else None
+
+
+# ─── LLM Cache ────────────────────────────────────────────────────────────────
+# كاش للردود المتكررة: نفس الموديل + نفس البرومبت + نفس السؤال (بعد التطبيع)
+class LLMCache:
+    def __init__(self, maxsize: int = 5000, ttl: float = 14400):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def cache_key(model: str, system_prompt: str, message: str) -> str:
+        normalized = normalize_query(message)
+        return hashlib.sha256(f"{model}|{system_prompt}|{normalized}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+# طبقة تانية: لو السؤال مش مطابق حرفياً بس معناه قريب جداً من سؤال اتجاوب قبل كده
+class SemanticCache:
+    # الـ vectors في matrix واحدة (ring buffer) والمقارنة dot product واحد في numpy،
+    # أقل من millisecond لـ 1000 entry فبتتنادى على الـ event loop على طول
+    def __init__(self, maxsize: int = 1000, ttl: float = 14400, threshold: float = 0.92):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        # الـ matrix بتتعمل مع أول vector (عشان نعرف الـ dimension)
+        self._matrix: Optional[np.ndarray] = None
+        self._stored_at = np.full(maxsize, -np.inf)
+        self._model_ids = np.full(maxsize, -1, dtype=np.int32)
+        self._models: dict = {}
+        self._values: list = [None] * maxsize
+        self._next = 0
+
+    def get(self, model: str, vector: bytes) -> Optional[str]:
+        model_id = self._models.get(model)
+        if self._matrix is None or model_id is None:
+            return None
+        q = np.frombuffer(vector, dtype=np.float32)
+        if q.shape[0] != self._matrix.shape[1]:
+            return None
+        valid = (self._model_ids == model_id) & (self._stored_at >= time.monotonic() - self.ttl)
+        scores = np.where(valid, self._matrix @ q, -np.inf)
+        best = int(scores.argmax())
+        return self._values[best] if scores[best] >= self.threshold else None
+
+    def set(self, model: str, vector: bytes, value: str):
+        v = np.frombuffer(vector, dtype=np.float32)
+        if self._matrix is None:
+            self._matrix = np.zeros((self.maxsize, v.shape[0]), dtype=np.float32)
+        elif v.shape[0] != self._matrix.shape[1]:
+            return
+        i = self._next
+        self._next = (i + 1) % self.maxsize
+        self._matrix[i] = v
+        self._stored_at[i] = time.monotonic()
+        self._model_ids[i] = self._models.setdefault(model, len(self._models))
+        self._values[i] = value
+
+
+llm_cache = LLMCache()
+semantic_cache = SemanticCache()
+
+
+# بيرجع embedding السؤال؛ _call_ai بيديه للـ API الاتنين عشان الـ embedding يتحسب مرة واحدة بس
+EmbedGetter = Callable[[], Awaitable[Optional[bytes]]]
+
+
+async def _cache_lookup(model: str, system_prompt: str, message: str, embed: Optional[EmbedGetter] = None):
+    # بيرجع (key, vector, الرد لو موجود). الكاش الحرفي الأول، وبعده الـ semantic
+    key = LLMCache.cache_key(model, system_prompt, message)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return key, None, cached
+    vector = await (embed() if embed else embed_query(message))
+    if vector:
+        cached = semantic_cache.get(model, vector)
+        if cached is not None:
+            llm_cache.set(key, cached)
+    return key, vector, cached
+
+
+def _cache_store(model: str, key: str, vector: Optional[bytes], value: str):
+    llm_cache.set(key, value)
+    if vector:
+        semantic_cache.set(model, vector, value)
 
 
 # ─── Groq API ─────────────────────────────────────────────────────────────────
@@ -174,65 +790,192 @@ SYSTEM_PROMPT = f"""أنت "حكيم" - المساعد الذكي لعيادة {
 - لما حد يسأل عن العيادة أو الدكتور: ديله المعلومات الكاملة
 - متضيفش تحذير طبي في ردود التحيات والكلام العام، بس ضيفه في الردود الطبية فقط
 - استخدم إيموجي بشكل خفيف"""
+GROQ_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
 
+PartialCallback = Callable[[str], Awaitable[None]]
+# زي PartialCallback بس معاه اسم الـ API اللي بيعمل streaming دلوقتي (عشان الـ label)
+SourcedPartialCallback = Callable[[str, str], Awaitable[None]]
 
-async def groq_chat(message: str, context_str: str = "") -> Optional[str]:
+
+async def _stream_sse(url: str, headers: dict, body: dict, limiter: ApiLimiter,
+                      extract, on_partial: PartialCallback) -> str:
+    # بيقرا رد SSE سطر سطر، وبيبعت النص المتجمع لـ on_partial مرة كل STREAM_EDIT_INTERVAL بالكتير
+    # الإعادة بتحصل بس قبل ما يوصل أول جزء، بعد كده المستخدم شاف نص فمش هنبدأ من الأول
+    parts = []
+    content = orjson.dumps(body)
+    loop = asyncio.get_running_loop()
+    last_emit = loop.time()
+    for attempt in range(RETRY_ATTEMPTS):
+        last = attempt == RETRY_ATTEMPTS - 1
+        try:
+            async with limiter, HTTP.stream("POST", url, headers=headers, content=content) as r:
+                if r.status_code in RETRY_STATUSES and not last:
+                    # الانتظار بيحصل بره الـ limiter والـ stream، فمش بنحجز slot ولا اتصال وإحنا مستنيين
+                    delay = _retry_delay(attempt, r)
+                    logger.warning("HTTP %d, retry %d in %.1fs", r.status_code, attempt + 1, delay)
+                else:
+                    r.raise_for_status()
+                    async for line in r.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        payload = line[5:].strip()
+                        if payload == "[DONE]":
+                            break
+                        delta = extract(orjson.loads(payload))
+                        if not delta:
+                            continue
+                        parts.append(delta)
+                        now = loop.time()
+                        if now - last_emit >= STREAM_EDIT_INTERVAL:
+                            last_emit = now
+                            await on_partial("".join(parts))
+                    return "".join(parts)
+        except httpx.TransportError as e:
+            if parts or last or isinstance(e, (httpx.ConnectTimeout, httpx.ReadTimeout)):
+                raise
+            delay = _retry_delay(attempt)
+            logger.warning("HTTP %s, retry %d in %.1fs", type(e).__name__, attempt + 1, delay)
+        await asyncio.sleep(delay)
+    return "".join(parts)
+
+
+def _groq_delta(chunk: dict) -> Optional[str]:
+    choices = chunk.get('choices')
+    return choices[0]['delta'].get('content') if choices else None
+
+
+def _gemini_delta(chunk: dict) -> Optional[str]:
+    candidates = chunk.get('candidates')
+    if not candidates:
+        return None
+    return "".join(p.get('text', '') for p in candidates[0].get('content', {}).get('parts', []))
+
+
+async def groq_chat(message: str, context_str: str = "",
+                    on_partial: Optional[PartialCallback] = None,
+                    embed: Optional[EmbedGetter] = None) -> Optional[str]:
     if not GROQ_API_KEY:
-        return "خدمة الذكاء الاصطناعي غير متاحة حالياً."
+        return None
+    # مش بنخزن في الكاش الردود اللي فيها بيانات المريض
+    key = vector = None
+    if not context_str:
+        key, vector, cached = await _cache_lookup(GROQ_MODEL, SYSTEM_PROMPT, message, embed)
+        if cached is not None:
+            return cached
     try:
-        prompt = SYSTEM_PROMPT
+        # الـ system prompt بيفضل ثابت بالبايت عشان prompt caching عند Groq، وبيانات المريض في رسالة لوحدها
+        messages = [GROQ_SYSTEM_MSG]
         if context_str:
-            prompt += f"\n\nمعلومات المريض: {context_str}"
-
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            r = await client.post(
-                GROQ_API_URL,
-                headers={"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"},
-                json={
-                    "model": "llama-3.3-70b-versatile",
-                    "messages": [
-                        {"role": "system", "content": prompt},
-                        {"role": "user", "content": message}
-                    ],
-                    "temperature": 0.7,
-                    "max_tokens": 800
-                }
-            )
-            r.raise_for_status()
-            return r.json()['choices'][0]['message']['content']
+            messages.append({"role": "system", "content": f"معلومات المريض: {context_str}"})
+        messages.append({"role": "user", "content": message})
+
+        body = {
+            "model": GROQ_MODEL,
+            "messages": messages,
+            "temperature": 0.5,
+            "max_tokens": GROQ_MAX_TOKENS
+        }
+        if on_partial:
+            body["stream"] = True
+            result = await _stream_sse(GROQ_API_URL, GROQ_HEADERS, body, GROQ_LIMITER, _groq_delta, on_partial) or None
+        else:
+            r = await _post(GROQ_API_URL, GROQ_HEADERS, body, GROQ_LIMITER)
+            result = orjson.loads(r.content)['choices'][0]['message']['content']
+        if key and result:
+            _cache_store(GROQ_MODEL, key, vector, result)
+        return result
     except httpx.TimeoutException:
-        return "الرد بياخد وقت، حاول تاني."
+        # بعد ما الـ retries خلصت؛ None عشان الطلب يروح لـ Gemini بداله
+        logger.warning("Groq timed out")
+        return None
     except Exception as e:
-        logger.error(f"Groq error: {e}")
+        logger.error("Groq error: %s", e)
         return None
 
 
-async def gemini_analyze(query: str, context_str: str = "") -> Optional[str]:
-    if not GEMINI_API_KEY:
-        return "خدمة التحليل الطبي غير متاحة حالياً."
-    try:
-        instruction = f"""أنت مساعد طبي متخصص في أمراض الجهاز الهضمي والكبد لعيادة {CLINIC['doctor']}.
+GEMINI_INSTRUCTION = f"""أنت مساعد طبي متخصص في أمراض الجهاز الهضمي والكبد لعيادة {CLINIC['doctor']}.
 قدم تحليلاً طبياً مفصلاً باللغة العربية المبسطة.
 في النهاية أضف: ⚠️ هذا للمعلومات فقط، استشر الطبيب دائماً."""
+GEMINI_INSTRUCTION_PART = {"text": GEMINI_INSTRUCTION}
+
+
+async def gemini_analyze(query: str, context_str: str = "",
+                         on_partial: Optional[PartialCallback] = None,
+                         embed: Optional[EmbedGetter] = None) -> Optional[str]:
+    if not GEMINI_API_KEY:
+        return None
+    key = vector = None
+    if not context_str:
+        key, vector, cached = await _cache_lookup(GEMINI_MODEL, GEMINI_INSTRUCTION, query, embed)
+        if cached is not None:
+            return cached
+    try:
+        instruction = [GEMINI_INSTRUCTION_PART]
         if context_str:
-            instruction += f"\nالمريض: {context_str}"
-
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            r = await client.post(
-                f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-                json={
-                    "contents": [{"parts": [{"text": query}]}],
-                    "systemInstruction": {"parts": [{"text": instruction}]},
-                    "generationConfig": {"temperature": 0.7, "maxOutputTokens": 1000}
-                }
-            )
-            r.raise_for_status()
-            data = r.json()
-            if data.get('candidates'):
-                return data['candidates'][0]['content']['parts'][0]['text']
+            instruction.append({"text": f"المريض: {context_str}"})
+
+        body = {
+            "contents": [{"parts": [{"text": query}]}],
+            "systemInstruction": {"parts": instruction},
+            "generationConfig": {"temperature": 0.5, "maxOutputTokens": GEMINI_MAX_TOKENS, "topP": 0.9}
+        }
+        if on_partial:
+            result = await _stream_sse(
+                GEMINI_STREAM_URL, GEMINI_HEADERS, body, GEMINI_LIMITER,
+                _gemini_delta, on_partial
+            ) or None
+        else:
+            r = await _post(GEMINI_API_URL, GEMINI_HEADERS, body, GEMINI_LIMITER)
+            data = orjson.loads(r.content)
+            result = data['candidates'][0]['content']['parts'][0]['text'] if data.get('candidates') else None
+        if key and result:
+            _cache_store(GEMINI_MODEL, key, vector, result)
+        return result
+    except Exception as e:
+        logger.error("Gemini error: %s", e)
+        return None
+
+
+# لو API فشل بعد الـ retries بنجرب التاني بدل ما المستخدم يشوف خطأ
+AI_CALLS    = {'groq': groq_chat, 'gemini': gemini_analyze}
+AI_FALLBACK = {'groq': 'gemini', 'gemini': 'groq'}
+AI_LABELS   = {'groq': "🤖 Groq", 'gemini': "🧠 Gemini"}
+# لو الأساسي مجاوبش ولا بدأ يبعت خلال الوقت ده (ثواني) بنشغل التاني بالتوازي وأول رد يكسب
+AI_HEDGE_DELAY = 3.0
+# من غير streaming الأساسي لازم يخلص الرد كله، فالمهلة أطول قبل ما نشغل التاني.
+# التكلفة: أي رد سليم بس أبطأ من كده بيتدفع مرتين (الطلب التاني بيتلغي بس الـ tokens اللي اتولدت بتتحسب)
+AI_HEDGE_DELAY_BLOCKING = 10.0
+# نفس المستخدم لو بعت نفس السؤال تاني خلال الوقت ده (ثواني) بياخد نفس الرد من غير طلب جديد
+RECENT_REPLY_TTL = 60
+# لما الاتنين يفشلوا: لو مفيش ولا key أصلاً الخدمة مش متاحة، غير كده خطأ مؤقت
+AI_FAILED_MSG = ("❌ حصل خطأ، حاول تاني." if GROQ_API_KEY or GEMINI_API_KEY
+                 else "❌ خدمة الذكاء الاصطناعي غير متاحة حالياً.")
+
+
+SUMMARY_PROMPT = """لخص المحادثة دي بين مريض والمساعد الطبي في 5 نقاط قصيرة بالعربي:
+الأعراض والمشاكل اللي اتكلم عنها، والنصايح المهمة. لو فيه ملخص قديم، ادمجه مع الجديد."""
+
+
+async def groq_summarize(previous: str, turns: list) -> Optional[str]:
+    if not GROQ_API_KEY:
         return None
+    dialog = "\n".join(f"المريض: {q}\nالمساعد: {a[:500]}" for q, a in turns)
+    if previous:
+        dialog = f"الملخص القديم:\n{previous}\n\n{dialog}"
+    try:
+        r = await _post(GROQ_API_URL, GROQ_HEADERS, {
+            "model": GROQ_MODEL,
+            "messages": [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": dialog}
+            ],
+            "temperature": 0.3,
+            "max_tokens": 300
+        }, GROQ_LIMITER)
+        return orjson.loads(r.content)['choices'][0]['message']['content']
     except Exception as e:
-        logger.error(f"Gemini error: {e}")
+        logger.error("Groq summarize error: %s", e)
         return None
 
 
@@ -240,16 +983,157 @@ async def gemini_analyze(query: str, context_str: str = "") -> Optional[str]:
 class MedicalBot:
     def __init__(self):
         self.db = PatientDatabase()
+        self._chat_q: asyncio.Queue = asyncio.Queue()
+        self._chat_writer_task: Optional[asyncio.Task] = None
+        self._checkpoint_task: Optional[asyncio.Task] = None
+        # تلخيص المحادثات شغال في الخلفية، بنحتفظ بالـ tasks عشان متتمسحش قبل ما تخلص
+        self._bg_tasks: set = set()
+        # آخر ردود كل مستخدم: (user_id, mode, text) -> (الرد، الـ API)
+        self._recent_replies = LLMCache(maxsize=1000, ttl=RECENT_REPLY_TTL)
+        # الـ updates بتتعالج بالتوازي، بس رسايل نفس المستخدم بالترتيب (lock لكل مستخدم بيتمسح لوحده لما محدش يستخدمه)
+        self._user_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+        # الحالة الحالية لكل مستخدم في context.user_data['state']، وكل حالة ليها handler واحد
+        self._dispatch = {
+            BOOKING_NAME:    self.book_get_name,
+            BOOKING_PHONE:   self.book_get_phone,
+            BOOKING_DAY:     self.book_get_day,
+            BOOKING_CONFIRM: self.book_confirm,
+            CHAT_MODE:       self.chat_select_mode,
+            CHAT_INPUT:      self.chat_input,
+        }
+        # زراير القائمة اللي بتشتغل لما المستخدم مش في نص حجز أو محادثة
+        self._idle_buttons = {
+            "👤 ملفي الشخصي": self.show_profile,
+            "❓ مساعدة":      self.help_command,
+        }
 
     # ── Helpers ──────────────────────────────────────────────────────────────
     def _is_confirm(self, text: str) -> bool:
-        confirms = ["✅", "أيوه", "ايوه", "اه", "آه", "أه", "نعم", "يلا", "اكد",
-                    "أكد", "تأكيد", "تمام", "صح", "موافق", "وافق", "ok", "okay", "yes"]
-        return any(w in text.lower() for w in confirms)
+        return CONFIRM_RE.search(text) is not None
 
     def _is_cancel(self, text: str) -> bool:
-        cancels = ["❌", "لأ", "لا", "الغ", "إلغاء", "cancel", "مش عايز", "مش عاوز"]
-        return any(w in text.lower() for w in cancels)
+        return CANCEL_RE.search(text) is not None
+
+    @staticmethod
+    def _chunks(text: str, size: int = TELEGRAM_MAX_LEN):
+        # بنقطع عند آخر سطر جديد جوه الحد لو موجود، عشان الفقرة متتقسمش في النص
+        start = 0
+        while len(text) - start > size:
+            cut = text.rfind("\n", start, start + size)
+            if cut <= start:
+                yield text[start:start + size]
+                start += size
+            else:
+                yield text[start:cut]
+                start = cut + 1
+        yield text[start:]
+
+    @staticmethod
+    async def _call_ai(mode: str, text: str, ctx: str, on_partial: Optional[SourcedPartialCallback]):
+        fallback = AI_FALLBACK[mode]
+        # من غير streaming مفيش إشارة إن الـ API بدأ يرد، فبنستنى الرد كله لحد AI_HEDGE_DELAY_BLOCKING
+        hedge_delay = AI_HEDGE_DELAY if on_partial else AI_HEDGE_DELAY_BLOCKING
+        started = asyncio.Event()
+        owner = []
+
+        def relay(name):
+            if on_partial is None:
+                return None
+
+            async def forward(partial: str):
+                # الـ streaming بيظهر من أول API بدأ يرد بس
+                if not owner:
+                    owner.append(name)
+                    started.set()
+                if owner[0] == name:
+                    await on_partial(name, partial)
+            return forward
+
+        # الـ embedding بتاع الـ semantic cache بيتحسب مرة واحدة حتى لو الاتنين اشتغلوا (hedge أو fallback)
+        # والـ shield عشان إلغاء الطلب الخسران ميلغيش الـ embedding على التاني
+        embedding = []
+
+        def embed():
+            if not embedding:
+                embedding.append(asyncio.ensure_future(embed_query(text)))
+            return asyncio.shield(embedding[0])
+
+        primary = asyncio.create_task(AI_CALLS[mode](text, ctx, relay(mode), embed))
+        waiter = asyncio.create_task(started.wait())
+        tasks = {primary: mode}
+        try:
+            await asyncio.wait({primary, waiter}, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+            if primary.done() or started.is_set():
+                response = await primary
+                if response is not None:
+                    return response, mode
+                logger.warning("%s failed, falling back to %s", mode, fallback)
+                # الأساسي خلص، فالـ streaming بيتنقل للـ fallback
+                owner.clear()
+                return await AI_CALLS[fallback](text, ctx, relay(fallback), embed), fallback
+            logger.warning("%s slow, hedging with %s", mode, fallback)
+            tasks[asyncio.create_task(AI_CALLS[fallback](text, ctx, relay(fallback), embed))] = fallback
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda t: t is not primary):
+                    if task.result() is not None:
+                        return task.result(), tasks[task]
+            return None, fallback
+        finally:
+            # الطلب اللي خسر بيتلغي، والـ async with جوه httpx والـ limiter بيقفلوا الاتصال ويرجعوا الـ slot
+            waiter.cancel()
+            for task in (*tasks, *embedding):
+                task.cancel()
+
+    async def _ask_ai(self, user_id: int, mode: str, text: str, ctx: str,
+                      on_partial: Optional[SourcedPartialCallback] = None):
+        # بيرجع (الرد، الـ API اللي جاوب فعلاً)
+        # رسايل نفس المستخدم بتستنى بعض (الـ lock بتاعه)، فالسؤال المكرر (ضغطة مكررة مثلاً)
+        # بيوصل بعد ما الأول خلص وبياخد رده من _recent_replies بدل طلب تاني
+        text = text[:MAX_QUERY_CHARS]
+        key = (user_id, mode, text)
+        recent = self._recent_replies.get(key)
+        if recent is not None:
+            return recent
+        result = await self._call_ai(mode, text, ctx, on_partial)
+        if result[0] is not None:
+            self._recent_replies.set(key, result)
+        return result
+
+    @staticmethod
+    def _patient_context(patient: Optional[dict], related: Optional[list] = None) -> str:
+        if not patient:
+            return ""
+        ctx = patient['name']
+        if patient.get('summary'):
+            ctx += f"\nملخص المحادثات اللي فاتت:\n{patient['summary']}"
+        if related:
+            ctx += "\nأسئلة سابقة للمريض ليها علاقة:\n" + "\n".join(
+                f"- س: {q}\n  ج: {a[:300]}" for q, a in related
+            )
+        return ctx
+
+    async def _related_history(self, user_id: int, vector: Optional[bytes]) -> list:
+        if vector is None:
+            return []
+        return await asyncio.to_thread(self.db.related_chats, user_id, vector)
+
+    def _remember_turn(self, context: ContextTypes.DEFAULT_TYPE, patient: dict, text: str, response: str):
+        # بنجمع الرسايل في user_data، وكل SUMMARY_EVERY_TURNS بنلخصهم في الخلفية مع الملخص القديم
+        turns = context.user_data.setdefault('turns', [])
+        turns.append((text, response))
+        if len(turns) < SUMMARY_EVERY_TURNS:
+            return
+        context.user_data['turns'] = []
+        task = asyncio.create_task(self._summarize(patient['telegram_id'], patient.get('summary') or "", turns))
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+
+    async def _summarize(self, user_id: int, previous: str, turns: list):
+        summary = await groq_summarize(previous, turns)
+        if summary:
+            await asyncio.to_thread(self.db.save_summary, user_id, summary)
 
     async def _send_main_menu(self, update: Update, msg: str = "اختار من القائمة:"):
         await update.message.reply_text(msg, reply_markup=MAIN_KEYBOARD)
@@ -258,50 +1142,36 @@ class MedicalBot:
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         name = update.effective_user.first_name
         await update.message.reply_text(
-            f"🏥 أهلاً وسهلاً يا {name}!\n\n"
-            f"أنا حكيم، المساعد الذكي لعيادة {CLINIC['doctor']}\n"
-            f"متخصص في {CLINIC['spec']} 🩺\n\n"
-            f"📍 {CLINIC['address']}\n"
-            f"📞 {CLINIC['phone']}\n"
-            f"🗓 {CLINIC['days']}\n\n"
-            "اسألني أي سؤال أو اختار من القائمة:",
+            f"🏥 أهلاً وسهلاً يا {name}!\n\n{WELCOME_TEXT}",
             reply_markup=MAIN_KEYBOARD
         )
 
     # ── Help ──────────────────────────────────────────────────────────────────
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.message.reply_text(
-            "📋 إيه اللي أقدر أعمله:\n\n"
-            "📅 حجز موعد - احجز في العيادة\n"
-            "💬 محادثة AI - اسأل أي سؤال طبي\n"
-            "🔬 تحليل طبي - تحليل عميق بـ Gemini\n"
-            "👤 ملفي - بياناتك المحفوظة\n\n"
-            f"📍 {CLINIC['address']}\n"
-            f"📞 {CLINIC['phone']}\n"
-            f"🗓 {CLINIC['days']}",
-            reply_markup=MAIN_KEYBOARD
-        )
+        await update.message.reply_text(HELP_TEXT, reply_markup=MAIN_KEYBOARD)
 
     # ── General AI message ────────────────────────────────────────────────────
     async def handle_general_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        text = update.message.text
+        msg = update.message
+        text = msg.text
 
         # زرار الرئيسية
-        if any(w in text for w in ["🏠", "الرئيسية", "رجوع", "القائمة"]):
+        if MENU_RE.search(text):
             await self._send_main_menu(update)
             return
 
         user_id = update.effective_user.id
-        await update.message.chat.send_action("typing")
-
-        patient = self.db.get_patient(user_id)
-        ctx = f"{patient['name']}" if patient else ""
+        # مؤشر الكتابة (طلب لـ Telegram) وبيانات المريض (DB) مع بعض بدل ورا بعض
+        _, patient = await asyncio.gather(
+            msg.chat.send_action("typing"), asyncio.to_thread(self.db.get_patient, user_id)
+        )
+        ctx = self._patient_context(patient)
 
-        response = await groq_chat(text, ctx)
+        response, _ = await self._ask_ai(user_id, 'groq', text, ctx)
         if response:
-            await update.message.reply_text(response, reply_markup=MAIN_KEYBOARD)
+            await msg.reply_text(response, reply_markup=MAIN_KEYBOARD)
         else:
-            await update.message.reply_text("حصل خطأ، حاول تاني. 🙏", reply_markup=MAIN_KEYBOARD)
+            await msg.reply_text(AI_FAILED_MSG, reply_markup=MAIN_KEYBOARD)
 
     # ── Booking Flow ──────────────────────────────────────────────────────────
     async def book_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -314,53 +1184,55 @@ class MedicalBot:
         return BOOKING_NAME
 
     async def book_get_name(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        name = update.message.text.strip()
+        msg = update.message
+        name = msg.text.strip()
         if len(name) < 2:
-            await update.message.reply_text("⚠️ من فضلك اكتب اسمك الكامل.")
+            await msg.reply_text("⚠️ من فضلك اكتب اسمك الكامل.")
             return BOOKING_NAME
         context.user_data['booking']['name'] = name
-        await update.message.reply_text(f"تمام يا {name} 👍\n\n📞 رقم تليفونك؟")
+        await msg.reply_text(f"تمام يا {name} 👍\n\n📞 رقم تليفونك؟")
         return BOOKING_PHONE
 
     async def book_get_phone(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        phone = update.message.text.strip().replace(" ", "").replace("-", "")
+        msg = update.message
+        phone = PHONE_SEPARATORS_RE.sub("", msg.text.strip())
         # التحقق من رقم مصري (01x) أو أي رقم 8+ أرقام
-        digits = ''.join(c for c in phone if c.isdigit())
+        digits = NON_DIGITS_RE.sub("", phone)
         if len(digits) < 8:
-            await update.message.reply_text("⚠️ الرقم مش صح، كتبه تاني من فضلك.")
+            await msg.reply_text("⚠️ الرقم مش صح، كتبه تاني من فضلك.")
             return BOOKING_PHONE
         context.user_data['booking']['phone'] = phone
-        keyboard = [["السبت", "الثلاثاء", "الأحد"]]
-        await update.message.reply_text(
+        await msg.reply_text(
             "📅 إيه اليوم اللي بيناسبك؟",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+            reply_markup=DAY_KEYBOARD
         )
         return BOOKING_DAY
 
     async def book_get_day(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        day = update.message.text.strip()
+        msg = update.message
+        day = msg.text.strip()
         context.user_data['booking']['day'] = day
         booking = context.user_data['booking']
 
-        keyboard = [["✅ تأكيد الحجز", "❌ تعديل"]]
-        await update.message.reply_text(
+        await msg.reply_text(
             f"📋 تأكيد بيانات الحجز:\n\n"
             f"👤 الاسم: {booking['name']}\n"
             f"📞 التليفون: {booking['phone']}\n"
             f"📅 اليوم: {booking['day']}\n"
             f"📍 العيادة: {CLINIC['address']}\n\n"
             "البيانات صح؟",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+            reply_markup=CONFIRM_KEYBOARD
         )
         return BOOKING_CONFIRM
 
     async def book_confirm(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        msg = update.message
         user_id = update.effective_user.id
-        text = update.message.text
+        text = msg.text
 
         if self._is_cancel(text):
             context.user_data['booking'] = {}
-            await update.message.reply_text(
+            await msg.reply_text(
                 "تمام! اكتب اسمك الكامل من الأول:",
                 reply_markup=ReplyKeyboardRemove()
             )
@@ -369,122 +1241,146 @@ class MedicalBot:
         if self._is_confirm(text):
             booking = context.user_data.get('booking', {})
             if not booking.get('name') or not booking.get('phone'):
-                await update.message.reply_text("حصل مشكلة، ابدأ من الأول.", reply_markup=MAIN_KEYBOARD)
-                return ConversationHandler.END
+                await msg.reply_text("حصل مشكلة، ابدأ من الأول.", reply_markup=MAIN_KEYBOARD)
+                return END
 
-            success = self.db.save_patient(user_id, booking['name'], booking['phone'], booking.get('day', ''))
+            success = await asyncio.to_thread(
+                self.db.save_patient, user_id, booking['name'], booking['phone'], booking.get('day', '')
+            )
 
             if success:
-                await update.message.reply_text(
-                    f"🎉 تم الحجز بنجاح يا {booking['name']}!\n\n"
-                    f"سيتواصل معك فريق العيادة لتأكيد الوقت.\n\n"
-                    f"📞 {CLINIC['phone']}\n"
-                    f"📍 {CLINIC['address']}\n"
-                    f"🗓 {CLINIC['days']}",
+                sends = [msg.reply_text(
+                    f"🎉 تم الحجز بنجاح يا {booking['name']}!\n\n{BOOKED_TEXT}",
                     reply_markup=MAIN_KEYBOARD
-                )
-                # إشعار الأدمن
+                )]
+                # إشعار الأدمن (بيتبعت بالتوازي مع رد المريض)
                 if ADMIN_ID:
-                    try:
-                        await context.bot.send_message(
-                            chat_id=ADMIN_ID,
-                            text=f"🔔 حجز جديد!\n\n"
-                                 f"👤 {booking['name']}\n"
-                                 f"📞 {booking['phone']}\n"
-                                 f"📅 {booking.get('day', 'غير محدد')}\n"
-                                 f"🆔 TG: {user_id}\n"
-                                 f"🕐 {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-                        )
-                    except Exception as e:
-                        logger.error(f"Admin notify error: {e}")
+                    sends.append(context.bot.send_message(
+                        chat_id=ADMIN_ID,
+                        text=f"🔔 حجز جديد!\n\n"
+                             f"👤 {booking['name']}\n"
+                             f"📞 {booking['phone']}\n"
+                             f"📅 {booking.get('day', 'غير محدد')}\n"
+                             f"🆔 TG: {user_id}\n"
+                             f"🕐 {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+                    ))
+                results = await asyncio.gather(*sends, return_exceptions=True)
+                for admin_result in results[1:]:
+                    if isinstance(admin_result, Exception):
+                        logger.error("Admin notify error: %s", admin_result)
+                if isinstance(results[0], Exception):
+                    raise results[0]
             else:
-                await update.message.reply_text(
+                await msg.reply_text(
                     "❌ حصل خطأ في الحفظ، حاول تاني.",
                     reply_markup=MAIN_KEYBOARD
                 )
-            return ConversationHandler.END
+            return END
 
         # لو كتب حاجة تانية
-        keyboard = [["✅ تأكيد الحجز", "❌ تعديل"]]
-        await update.message.reply_text(
+        await msg.reply_text(
             "اضغط على أحد الزرارين 👆",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+            reply_markup=CONFIRM_KEYBOARD
         )
         return BOOKING_CONFIRM
 
     async def book_cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        context.user_data.pop('state', None)
         await update.message.reply_text("تم الإلغاء.", reply_markup=MAIN_KEYBOARD)
-        return ConversationHandler.END
+        return END
 
     # ── Chat AI Flow ──────────────────────────────────────────────────────────
     async def chat_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        keyboard = [["🤖 Groq - سريع", "🧠 Gemini - تحليل عميق"], ["🏠 رجوع"]]
         await update.message.reply_text(
             "💬 اختار نوع الذكاء الاصطناعي:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            reply_markup=CHAT_MODE_KEYBOARD
         )
         return CHAT_MODE
 
     async def chat_select_mode(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        text = update.message.text
-        if "رجوع" in text or "🏠" in text:
+        msg = update.message
+        text = msg.text
+        if MENU_RE.search(text):
             await self._send_main_menu(update)
-            return ConversationHandler.END
+            return END
         if "Groq" in text or "سريع" in text:
             context.user_data['chat_mode'] = 'groq'
-            await update.message.reply_text(
+            await msg.reply_text(
                 "🤖 Groq جاهز! اسألني أي سؤال:\n(اكتب 'رجوع' للخروج)",
-                reply_markup=ReplyKeyboardMarkup([["🏠 رجوع"]], resize_keyboard=True)
+                reply_markup=BACK_KEYBOARD
             )
         elif "Gemini" in text or "تحليل" in text:
             context.user_data['chat_mode'] = 'gemini'
-            await update.message.reply_text(
+            await msg.reply_text(
                 "🧠 Gemini جاهز! اكتب سؤالك:\n(اكتب 'رجوع' للخروج)",
-                reply_markup=ReplyKeyboardMarkup([["🏠 رجوع"]], resize_keyboard=True)
+                reply_markup=BACK_KEYBOARD
             )
         else:
-            await update.message.reply_text("اختار من الزرارين.")
+            await msg.reply_text("اختار من الزرارين.")
             return CHAT_MODE
         return CHAT_INPUT
 
     async def chat_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        text = update.message.text
+        msg = update.message
+        text = msg.text
         # خروج
-        if any(w in text for w in ["رجوع", "🏠", "خروج", "الرئيسية", "القائمة"]):
+        if EXIT_RE.search(text):
             await self._send_main_menu(update, "رجعنا للقائمة الرئيسية 😊")
-            return ConversationHandler.END
+            return END
 
         user_id = update.effective_user.id
-        await update.message.chat.send_action("typing")
-
         mode = context.user_data.get('chat_mode', 'groq')
-        patient = self.db.get_patient(user_id)
-        ctx = patient['name'] if patient else ""
+        _, patient = await asyncio.gather(
+            msg.chat.send_action("typing"), asyncio.to_thread(self.db.get_patient, user_id)
+        )
+        # الـ embedding بيتحسب مرة واحدة: للتاريخ المشابه هنا، وبعدين بيتحفظ مع الرسالة
+        vector = await embed_query(text) if patient else None
+        related = await self._related_history(user_id, vector) if patient else None
+        ctx = self._patient_context(patient, related)
+
+        # الرد بيتبعت رسالة واحدة وبيتعدل كل ما يوصل جزء جديد من الـ API
+        reply = None
+        shown = ""
+
+        async def show_partial(api: str, partial: str):
+            # الـ label بتاع الـ API اللي بيرد فعلاً (ممكن يكون الـ fallback)
+            nonlocal reply, shown
+            preview = f"{AI_LABELS[api]}:\n\n{partial}"[:TELEGRAM_MAX_LEN - 2] + " ▌"
+            if preview == shown:
+                return
+            try:
+                if reply is None:
+                    reply = await msg.reply_text(preview)
+                else:
+                    await reply.edit_text(preview)
+                shown = preview
+            except TelegramError as e:
+                logger.warning("stream edit error: %s", e)
 
-        if mode == 'groq':
-            response = await groq_chat(text, ctx)
-            label = "🤖 Groq"
-        else:
-            response = await gemini_analyze(text, ctx)
-            label = "🧠 Gemini"
+        response, used = await self._ask_ai(user_id, mode, text, ctx, show_partial)
 
         if response:
             if patient:
-                self.db.save_chat(user_id, text, response, mode)
-            # تقسيم الرد لو طويل
-            if len(response) > 4000:
-                for i in range(0, len(response), 4000):
-                    await update.message.reply_text(response[i:i+4000])
-            else:
-                await update.message.reply_text(f"{label}:\n\n{response}")
+                self._chat_q.put_nowait((user_id, text, response, used, vector))
+                self._remember_turn(context, patient, text, response)
+            # تقسيم الرد لو طويل، والـ label في أول جزء بس (بتاع الـ API اللي جاوب فعلاً)
+            chunks = self._chunks(f"{AI_LABELS[used]}:\n\n{response}")
+            if reply is not None:
+                # أول جزء بيتكتب في رسالة الـ streaming
+                await reply.edit_text(next(chunks))
+            # لازم الأجزاء توصل بالترتيب، فبتتبعت ورا بعض
+            for chunk in chunks:
+                await msg.reply_text(chunk)
+        elif reply is not None:
+            await reply.edit_text(AI_FAILED_MSG)
         else:
-            await update.message.reply_text("❌ حصل خطأ، حاول تاني.")
+            await msg.reply_text(AI_FAILED_MSG)
 
         return CHAT_INPUT
 
     # ── Profile ───────────────────────────────────────────────────────────────
     async def show_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        patient = self.db.get_patient(update.effective_user.id)
+        patient = await asyncio.to_thread(self.db.get_patient, update.effective_user.id)
         if patient:
             msg = (f"👤 ملفك الشخصي:\n\n"
                    f"الاسم: {patient['name']}\n"
@@ -497,32 +1393,65 @@ class MedicalBot:
 
     # ── Admin Commands ─────────────────────────────────────────────────────────
     async def show_bookings(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        msg = update.message
         if not ADMIN_ID or str(update.effective_user.id) != str(ADMIN_ID):
-            await update.message.reply_text("❌ للمشرف فقط.")
+            await msg.reply_text("❌ للمشرف فقط.")
             return
 
-        patients = self.db.get_all_patients()
-        if not patients:
-            await update.message.reply_text("📭 مفيش حجوزات لسه.")
+        total = await asyncio.to_thread(self.db.count)
+        if not total:
+            await msg.reply_text("📭 مفيش حجوزات لسه.")
+            return
+
+        # /bookings 2 → الصفحة التانية
+        try:
+            page_no = max(1, int(context.args[0])) if context.args else 1
+        except ValueError:
+            page_no = 1
+        last_page = (total + BOOKINGS_PAGE_SIZE - 1) // BOOKINGS_PAGE_SIZE
+        if page_no > last_page:
+            await msg.reply_text(f"📭 الصفحة {page_no} فاضية، آخر صفحة {last_page}.")
             return
+        offset = (page_no - 1) * BOOKINGS_PAGE_SIZE
 
-        msg = f"📋 الحجوزات ({len(patients)} حجز)\n{'─'*25}\n\n"
-        for i, (name, phone, day, created) in enumerate(patients, 1):
-            entry = f"#{i} 👤 {name}\n📞 {phone}\n📅 {day or 'غير محدد'}\n🕐 {created[:16]}\n{'─'*20}\n"
-            if len(msg) + len(entry) > 4000:
-                await update.message.reply_text(msg)
-                msg = ""
-            msg += entry
-        if msg:
-            await update.message.reply_text(msg)
+        parts = [f"📋 الحجوزات ({total} حجز) - صفحة {page_no}/{last_page}\n{'─'*25}\n\n"]
+        size = len(parts[0])
+        separator = '─' * 20
+        pages = self.db.iter_patients(BOOKINGS_PAGE_SIZE, offset)
+        i = offset
+        try:
+            while (page := await asyncio.to_thread(next, pages, None)) is not None:
+                for name, phone, day, booked in page:
+                    i += 1
+                    entry = f"#{i} 👤 {name}\n📞 {phone}\n📅 {day or 'غير محدد'}\n🕐 {booked[:16]}\n{separator}\n"
+                    if size + len(entry) > TELEGRAM_MAX_LEN:
+                        await msg.reply_text("".join(parts))
+                        parts.clear()
+                        size = 0
+                    parts.append(entry)
+                    size += len(entry)
+        finally:
+            pages.close()
+        # رابط الصفحة الجاية بيتضاف لآخر رسالة لو فيها مكان، بدل رسالة لوحدها
+        if page_no < last_page:
+            hint = f"\n➡️ للصفحة اللي بعدها: /bookings {page_no + 1}"
+            if size + len(hint) > TELEGRAM_MAX_LEN:
+                await msg.reply_text("".join(parts))
+                parts.clear()
+            parts.append(hint)
+        if parts:
+            await msg.reply_text("".join(parts))
 
     async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        msg = update.message
         if not ADMIN_ID or str(update.effective_user.id) != str(ADMIN_ID):
-            await update.message.reply_text("❌ للمشرف فقط.")
+            await msg.reply_text("❌ للمشرف فقط.")
             return
-        total = self.db.count()
-        db_size = Path('patients.db').stat().st_size / 1024 if Path('patients.db').exists() else 0
-        await update.message.reply_text(
+        total, size_bytes = await asyncio.gather(
+            asyncio.to_thread(self.db.count), asyncio.to_thread(self.db.db_size_bytes)
+        )
+        db_size = size_bytes / 1024
+        await msg.reply_text(
             f"📊 الإحصائيات:\n\nإجمالي المرضى: {total}\n"
             f"حجم DB: {db_size:.2f} KB\n"
             f"آخر تحديث: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
@@ -530,82 +1459,175 @@ class MedicalBot:
 
     # ── Error handler ─────────────────────────────────────────────────────────
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        logger.error(f"Error: {context.error}", exc_info=context.error)
+        logger.error("Error: %s", context.error, exc_info=context.error)
         if update and update.message:
             try:
                 await update.message.reply_text("❌ حصل خطأ، حاول تاني.", reply_markup=MAIN_KEYBOARD)
             except:
                 pass
 
+    # ── Routing ───────────────────────────────────────────────────────────────
+    def _locked(self, handler):
+        # أي handler بيقرا أو يغير حالة المستخدم بياخد نفس الـ lock، عشان /cancel مثلاً ميترجعش
+        # لما handler لسه شغال يكتب الـ state بتاعه بعده
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            user_id = update.effective_user.id
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = asyncio.Lock()
+            async with lock:
+                return await handler(update, context)
+        return wrapper
+
+    async def _route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        msg = update.message
+        text = msg.text
+        state = context.user_data.get('state')
+
+        # الحجز بيبدأ من أي حالة، والمحادثة من أي حالة غير الحجز
+        if BOOKING_TRIGGER.filter(msg):
+            handler = self.book_start
+        elif state not in BOOKING_STATES and text in CHAT_BUTTONS:
+            handler = self.chat_start
+        elif state in self._dispatch:
+            handler = self._dispatch[state]
+        else:
+            handler = self._idle_buttons.get(text, self.handle_general_message)
+
+        next_state = await handler(update, context)
+        if next_state == END:
+            context.user_data.pop('state', None)
+        elif next_state is not None:
+            context.user_data['state'] = next_state
+
+    # ── Chat history writer ──────────────────────────────────────────────────
+    async def _chat_writer(self):
+        # بيجمع الرسايل لحد CHAT_BATCH_SIZE أو CHAT_FLUSH_INTERVAL ويكتبهم مرة واحدة
+        loop = asyncio.get_running_loop()
+        while True:
+            row = await self._chat_q.get()
+            if row is None:
+                return
+            rows = [row]
+            stop = False
+            deadline = loop.time() + CHAT_FLUSH_INTERVAL
+            while len(rows) < CHAT_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._chat_q.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    stop = True
+                    break
+                rows.append(row)
+            # الصفوف اللي ملهاش embedding من chat_input بتتحسب كلها في طلب واحد؛ لو فشل بتتحفظ من غيره
+            missing = [i for i, r in enumerate(rows) if r[4] is None]
+            if missing:
+                vectors = await gemini_embed([rows[i][1] for i in missing])
+                if vectors and len(vectors) == len(missing):
+                    for i, v in zip(missing, vectors):
+                        rows[i] = (*rows[i][:4], v)
+            await asyncio.to_thread(self.db.save_chats, rows)
+            if stop:
+                return
+
+    async def _checkpoint_loop(self):
+        # السجل القديم بيتمسح عند التشغيل وبعدين مرة كل CHAT_PRUNE_INTERVAL، عشان البوت اللي شغال شهور يلتزم بـ CHAT_RETENTION_DAYS
+        loop = asyncio.get_running_loop()
+        await asyncio.to_thread(self.db.prune_chats)
+        last_prune = loop.time()
+        while True:
+            await asyncio.sleep(WAL_CHECKPOINT_INTERVAL)
+            if loop.time() - last_prune >= CHAT_PRUNE_INTERVAL:
+                await asyncio.to_thread(self.db.prune_chats)
+                last_prune = loop.time()
+            await asyncio.to_thread(self.db.checkpoint)
+
+    # ── Lifecycle ─────────────────────────────────────────────────────────────
+    async def post_init(self, app: Application):
+        self._chat_writer_task = asyncio.create_task(self._chat_writer())
+        self._checkpoint_task = asyncio.create_task(self._checkpoint_loop())
+
+    async def post_shutdown(self, app: Application):
+        if self._checkpoint_task:
+            self._checkpoint_task.cancel()
+            await asyncio.gather(self._checkpoint_task, return_exceptions=True)
+        if self._chat_writer_task:
+            # None = إشارة للـ writer إنه يكتب اللي فاضل ويقفل
+            self._chat_q.put_nowait(None)
+            await self._chat_writer_task
+        if self._bg_tasks:
+            await asyncio.gather(*self._bg_tasks, return_exceptions=True)
+        await asyncio.to_thread(self.db.close)
+        await HTTP.aclose()
+
     # ── Build App ─────────────────────────────────────────────────────────────
     def build(self) -> Application:
-        app = Application.builder().token(TELEGRAM_TOKEN).build()
-
-        # ── Booking conversation ──
-        # الكلمات اللي بتفتح الحجز
-        BOOKING_TRIGGER = (
-            r"📅 حجز موعد|"
-            r"عايز احجز|عاوز احجز|محتاج احجز|محتاجه احجز|"
-            r"أريد حجز|اريد حجز|ابي احجز|بدي احجز|"
-            r"عايز اعمل حجز|عاوز اعمل حجز|"
-            r"حجزلي|حجزني|احجزلي|احجزني|"
-            r"^احجز$|^حجز$|موعد كشف|عايز موعد|عاوز موعد|محتاج موعد"
-        )
-
-        booking_conv = ConversationHandler(
-            entry_points=[
-                MessageHandler(filters.Regex(BOOKING_TRIGGER), self.book_start),
-            ],
-            states={
-                BOOKING_NAME:    [MessageHandler(filters.TEXT & ~filters.COMMAND, self.book_get_name)],
-                BOOKING_PHONE:   [MessageHandler(filters.TEXT & ~filters.COMMAND, self.book_get_phone)],
-                BOOKING_DAY:     [MessageHandler(filters.TEXT & ~filters.COMMAND, self.book_get_day)],
-                BOOKING_CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.book_confirm)],
-            },
-            fallbacks=[
-                CommandHandler("cancel", self.book_cancel),
-                MessageHandler(filters.Regex(r"^/start$"), self.start),
-            ],
-            allow_reentry=True
-        )
-
-        # ── Chat conversation ──
-        chat_conv = ConversationHandler(
-            entry_points=[
-                MessageHandler(filters.Regex(r"💬 محادثة ذكاء اصطناعي|🔬 تحليل طبي"), self.chat_start),
-            ],
-            states={
-                CHAT_MODE:  [MessageHandler(filters.TEXT & ~filters.COMMAND, self.chat_select_mode)],
-                CHAT_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.chat_input)],
-            },
-            fallbacks=[
-                CommandHandler("cancel", self.book_cancel),
-                MessageHandler(filters.Regex(r"^/start$"), self.start),
-            ],
-            allow_reentry=True
+        app = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            # من غير كده PTB بيعالج update واحد في المرة، فرد الـ AI لمستخدم بيأخر الكل
+            .concurrent_updates(32)
+            # حدود Telegram (30 رسالة/ثانية، 20/دقيقة للجروب) بتتطبق محلياً، والـ RetryAfter بيستنى ويعيد هنا مش في الـ handler
+            .rate_limiter(AIORateLimiter(max_retries=2))
+            # الـ pool الافتراضي لطلبات Bot API اتصال واحد بس، فالردود المتوازية كانت بتستنى بعض
+            .connection_pool_size(128)
+            .pool_timeout(10)
+            .connect_timeout(10)
+            .read_timeout(15)
+            .write_timeout(15)
+            # getUpdates ليه اتصال لوحده، فالـ long polling مبيحجزش اتصال من الـ pool
+            .get_updates_connection_pool_size(1)
+            .get_updates_pool_timeout(60)
+            .get_updates_connect_timeout(10)
+            .get_updates_read_timeout(35)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
         )
 
         # ── Handlers ──
-        app.add_handler(CommandHandler("start", self.start))
+        app.add_handler(CommandHandler("start", self._locked(self.start)))
         app.add_handler(CommandHandler("help", self.help_command))
         app.add_handler(CommandHandler("stats", self.stats))
         app.add_handler(CommandHandler("bookings", self.show_bookings))
-        app.add_handler(booking_conv)
-        app.add_handler(chat_conv)
-        app.add_handler(MessageHandler(filters.Regex(r"^👤 ملفي الشخصي$"), self.show_profile))
-        app.add_handler(MessageHandler(filters.Regex(r"^❓ مساعدة$"), self.help_command))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_general_message))
+        app.add_handler(CommandHandler("cancel", self._locked(self.book_cancel)))
+        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self._locked(self._route)))
         app.add_error_handler(self.error_handler)
 
         return app
 
 
 def main():
+    # uvloop (libuv) أسرع من الـ loop العادي، ولو مش متسطب بنكمل عادي
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     logger.info("🚀 Starting Hakeem Medical Bot...")
     bot = MedicalBot()
     app = bot.build()
     logger.info("✓ Bot is running!")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # البوت بيتعامل مع الرسائل بس، فمش محتاجين Telegram يبعت باقي أنواع الـ updates
+    if WEBHOOK_URL:
+        # Telegram بيبعت الـ updates على طول بدل getUpdates كل شوية
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=TELEGRAM_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=[Update.MESSAGE]
+        )
+    else:
+        # long polling: كل getUpdates بيفضل مفتوح لحد 30 ثانية لحد ما رسالة توصل، بدل طلبات كل 10 ثواني والبوت فاضي
+        app.run_polling(allowed_updates=[Update.MESSAGE], timeout=30, poll_interval=0.0, bootstrap_retries=-1)
 
 
 if __name__ == "__main__":
@@ -1,18 +1,37 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
+import re
+import asyncio
+import atexit
 import logging
+import queue
+import threading
 import httpx
+import orjson
 import csv
+import itertools
 import random
+import time
+from collections import OrderedDict
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from telegram.constants import ChatAction
 
-# إعدادات التسجيل
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+from arabic_text import normalize_arabic, normalize_query
+
+# إعدادات التسجيل: الكتابة على الشاشة في thread منفصل عشان متوقفش الـ event loop
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_listener = QueueListener(_log_queue, _log_handler)
+logging.getLogger().setLevel(logging.INFO)
+logging.getLogger().addHandler(QueueHandler(_log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
@@ -24,71 +43,331 @@ ADMIN_ID = os.getenv("ADMIN_ID") # الأدمين الأساسي من ملف .en
 RECEPTIONIST_USER_ID = "7786956319" 
 
 GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+GROQ_MODEL = "llama-3.3-70b-versatile"
+# حد لطول الرد ولطول سؤال المريض اللي بيتبعت لـ Groq
+GROQ_MAX_TOKENS = 400
+MAX_QUERY_CHARS = 2000
+# الهيدرز ورسالة الـ system ثابتين، بيتبنوا مرة واحدة بدل كل رسالة
+GROQ_HEADERS = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
+GROQ_SYSTEM_MSG = {"role": "system", "content": "أنت مساعد د. أحمد سمير. أجب باحترافية بناءً على المرجع."}
 EXCEL_FILE = "clinic_bookings.csv"
 
+# 429 و 5xx المؤقتة بنعيدها مرتين بسرعة قبل ما نرجع رد الاعتذار
+RETRY_ATTEMPTS = 3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# أقصى وقت للمحاولات كلها (بالثواني) قبل رد الاعتذار
+RETRY_BUDGET = 8.0
+
+# كلمات الحجز في regex واحد متجمع مرة واحدة: بحث واحد على الرسالة بدل بحث لكل كلمة
+BOOKING_RE = re.compile(r"حجز|احجز|اسم|رقم|موعد|ميعاد")
+
+# client واحد طول عمر البوت بدل client جديد (و TLS handshake جديد) مع كل رسالة
+HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(connect=3.0, read=25.0, write=5.0, pool=5.0),
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=300),
+)
+
 # تجهيز ملف الإكسيل
 if not os.path.exists(EXCEL_FILE):
     with open(EXCEL_FILE, 'w', newline='', encoding='utf-8-sig') as f:
         writer = csv.writer(f)
         writer.writerow(["رقم الحجز", "الاسم", "التاريخ", "التوقيت", "البيانات المستلمة"])
 
-def get_knowledge():
-    if os.path.exists("knowledge.txt"):
-        with open("knowledge.txt", "r", encoding="utf-8") as f:
-            return f.read()
-    return "عيادة د. أحمد سمير عبد الحميد - استشاري الكبد والجهاز الهضمي."
+class BookingLog:
+    # الحجوزات بتدخل queue، وtask واحدة في الخلفية بتكتبها على دفعات في ملف مفتوح طول الوقت (في thread)
+    def __init__(self, path: str = EXCEL_FILE, batch_size: int = 50, flush_interval: float = 1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._file = None
+        self._writer = None
+        # الدفعة اللي اتسحبت من الـ queue ولسه متكتبتش (عشان flush_sync متضيعهاش لو الـ task اتلغت)
+        self._batch = []
+        # الكتابة في الملف بتتم في thread؛ الـ lock بيخلي flush_sync تستنى أي كتابة لسه شغالة بدل ما تكتب معاها
+        self._file_lock = threading.Lock()
+
+    def put(self, row):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._queue.put_nowait(row)
+
+    def _write(self, rows):
+        with self._file_lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', newline='', encoding='utf-8-sig')
+                self._writer = csv.writer(self._file)
+            self._writer.writerows(rows)
+            self._file.flush()
+
+    def _close_file(self):
+        with self._file_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            row = await self._queue.get()
+            if row is None:
+                return
+            rows = self._batch = [row]
+            stop = False
+            deadline = loop.time() + self.flush_interval
+            while len(rows) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    stop = True
+                    break
+                rows.append(row)
+            # الدفعة بتتسلم للـ thread قبل الكتابة: لو الـ loop اتقفل في النص الـ thread بيكمل كتابتها
+            # وflush_sync متكتبهاش تاني
+            self._batch = []
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except Exception as e:
+                # أي خطأ بيتسجل والـ task بتكمل، عشان الحجوزات الجاية متقفش
+                logger.error("Booking CSV error (%d rows): %s", len(rows), e)
+            if stop:
+                return
+
+    async def close(self):
+        # من post_shutdown: None = إشارة إن الـ task تكتب اللي فاضل وتقفل، وبعدين الملف بيتقفل
+        if self._task is not None:
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+        await asyncio.to_thread(self._close_file)
+
+    def flush_sync(self):
+        # آخر حل وقت الخروج (atexit) لو post_shutdown مشتغلش: بنكتب اللي فاضل في الـ queue من غير await
+        rows = self._batch
+        self._batch = []
+        while True:
+            try:
+                row = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if row is not None:
+                rows.append(row)
+        try:
+            if rows:
+                self._write(rows)
+        except Exception as e:
+            logger.error("Booking CSV error (%d rows): %s", len(rows), e)
+        self._close_file()
+
+booking_log = BookingLog()
+atexit.register(booking_log.flush_sync)
+
+KNOWLEDGE_FILE = "knowledge.txt"
+DEFAULT_KNOWLEDGE = "عيادة د. أحمد سمير عبد الحميد - استشاري الكبد والجهاز الهضمي."
+# البرومبت كله ثابت ما عدا سؤال المريض في الآخر
+PROMPT_TEMPLATE = "المرجع للعيادة:\n{kb}\n\nالوضع الحالي: {mode}\nسؤال المريض: "
+
+class KnowledgeCache:
+    # knowledge.txt بيتقري تاني بس لو اتعدل، والبرومبت لكل mode بيتبني مرة واحدة (ثابت فالـ prefix cache بتاع Groq يشتغل)
+    def __init__(self, path: str = KNOWLEDGE_FILE):
+        self.path = path
+        self._mtime = None
+        self._text = DEFAULT_KNOWLEDGE
+        self._prompts = {}
+
+    def prefix(self, mode: str) -> str:
+        self._refresh()
+        prompt = self._prompts.get(mode)
+        if prompt is None:
+            prompt = self._prompts[mode] = PROMPT_TEMPLATE.format(kb=self._text, mode=mode)
+        return prompt
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            if mtime is None:
+                text = DEFAULT_KNOWLEDGE
+            else:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    text = f.read()
+            self._mtime = mtime
+            self._text = text
+            self._prompts.clear()
+
+knowledge = KnowledgeCache()
 
 class MedicalEngine:
+    def __init__(self, maxsize: int = 2048, ttl: float = 3600):
+        # نفس السؤال بالحرف (بعد توحيد المسافات) بيرجع من الذاكرة من غير طلب لـ Groq
+        self._exact = OrderedDict()
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+    def _cached(self, key):
+        entry = self._exact.get(key)
+        if entry is None:
+            return None
+        response, inserted_at = entry
+        if time.time() - inserted_at > self.ttl:
+            del self._exact[key]
+            return None
+        self._exact.move_to_end(key)
+        return response
+
+    def _remember(self, key, response):
+        self._exact[key] = (response, time.time())
+        self._exact.move_to_end(key)
+        if len(self._exact) > self.maxsize:
+            self._exact.popitem(last=False)
+
     async def get_response(self, query: str, mode: str):
-        local_info = get_knowledge()
-        prompt = f"المرجع للعيادة:\n{local_info}\n\nالوضع الحالي: {mode}\nسؤال المريض: {query}"
+        query = query[:MAX_QUERY_CHARS]
+        # البرومبت الثابت (knowledge + mode) جزء من المفتاح: لو knowledge.txt اتعدل الردود القديمة مبترجعش
+        prefix = knowledge.prefix(mode)
+        key = (prefix, normalize_query(query))
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+        prompt = prefix + query
+        payload = {
+            "model": GROQ_MODEL,
+            "messages": [GROQ_SYSTEM_MSG, {"role": "user", "content": prompt}],
+            "max_tokens": GROQ_MAX_TOKENS
+        }
         try:
-            headers = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
-            payload = {
-                "model": "llama-3.3-70b-versatile",
-                "messages": [
-                    {"role": "system", "content": "أنت مساعد د. أحمد سمير. أجب باحترافية بناءً على المرجع."},
-                    {"role": "user", "content": prompt}
-                ]
-            }
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                r = await client.post(GROQ_URL, json=payload, headers=headers)
-                if r.status_code == 200:
-                    return r.json()['choices'][0]['message']['content']
-        except Exception as e:
-            logger.error(f"AI Error: {e}")
+            response = await asyncio.wait_for(self._groq_call(orjson.dumps(payload)), RETRY_BUDGET)
+        except asyncio.TimeoutError:
+            logger.error("AI Error: no reply within %gs", RETRY_BUDGET)
+            response = None
+        if response is not None:
+            self._remember(key, response)
+            return response
         return "شكراً لتواصلك. يرجى تزويدنا بالاسم ورقم الهاتف للحجز."
 
+    async def _groq_call(self, body: bytes):
+        for attempt in range(RETRY_ATTEMPTS):
+            delay = random.uniform(0, min(2.0, 0.2 * 2 ** attempt))  # exponential backoff مع jitter كامل
+            try:
+                r = await HTTP.post(GROQ_URL, content=body, headers=GROQ_HEADERS)
+                if r.status_code == 200:
+                    return orjson.loads(r.content)['choices'][0]['message']['content']
+                logger.error("AI Error: HTTP %d", r.status_code)
+                # باقي الـ 4xx (مفتاح غلط، طلب غلط) مش هتتصلح بالإعادة
+                if r.status_code not in RETRY_STATUSES:
+                    return None
+                # لو Groq قال يستنى قد إيه بنستنى المدة دي بالظبط
+                retry_after = r.headers.get("retry-after", "")
+                if retry_after.replace(".", "", 1).isdigit():
+                    delay = float(retry_after)
+            except httpx.ConnectTimeout as e:
+                # Groq مش بيرد على الاتصال أصلاً، فالإعادة هتضيع الـ RETRY_BUDGET من غير فايدة
+                logger.error("AI Error: %s", e)
+                return None
+            except httpx.TransportError as e:
+                logger.error("AI Error: %s", e)
+            except Exception as e:
+                logger.error("AI Error: %s", e)
+                return None
+            if attempt < RETRY_ATTEMPTS - 1:
+                await asyncio.sleep(delay)
+        return None
+
 engine = MedicalEngine()
 
+def last_booking_id(path: str = EXCEL_FILE) -> int:
+    # أكبر رقم حجز في الملف، عشان الترقيم يكمل بعده بعد الـ restart
+    last = 0
+    try:
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            for row in csv.reader(f):
+                if row and row[0].isdigit():
+                    last = max(last, int(row[0]))
+    except OSError as e:
+        logger.error("Booking CSV read error: %s", e)
+    return last
+
+# أرقام الحجز متزايدة بدل random من 9000 رقم بس كانت بتتكرر: بتبدأ بعد آخر رقم في الملف
+# (أو من وقت التشغيل لو أكبر)، فمبتتكررش حتى بعد الـ restart
+BOOKING_COUNTER = itertools.count(max(last_booking_id() + 1, int(time.time())))
+
+# رسالة الترحيب والكيبورد ثابتين، بيتبنوا مرة واحدة
+WELCOME_TEXT = "🏥 أهلاً بك في عيادة د. أحمد سمير عبد الحميد.\nاستشاري أمراض الكبد والجهاز الهضمي والمناظير.\nكيف يمكنني مساعدتك؟"
+WELCOME_MARKUP = ReplyKeyboardMarkup([["🏥 حجز موعد"], ["📍 استشارة طبية"]], resize_keyboard=True)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    kb = [["🏥 حجز موعد"], ["📍 استشارة طبية"]]
-    await update.message.reply_text(
-        "🏥 أهلاً بك في عيادة د. أحمد سمير عبد الحميد.\nاستشاري أمراض الكبد والجهاز الهضمي والمناظير.\nكيف يمكنني مساعدتك؟",
-        reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    )
+    await update.message.reply_text(WELCOME_TEXT, reply_markup=WELCOME_MARKUP)
 
 async def handle_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     user = update.effective_user
     
     # تحديد إذا كان الطلب حجز
-    is_booking = any(k in text for k in ["حجز", "احجز", "اسم", "رقم", "موعد"])
+    is_booking = BOOKING_RE.search(normalize_arabic(text)) is not None
     mode = "booking" if is_booking else "consultation"
 
     booking_id = None
     if is_booking:
-        booking_id = random.randint(1000, 9999)
-        # 1. الحفظ في الإكسيل
-        with open(EXCEL_FILE, 'a', newline='', encoding='utf-8-sig') as f:
-            csv.writer(f).writerow([booking_id, user.full_name, datetime.now().strftime("%Y-%m-%d"), datetime.now().strftime("%H:%M"), text])
+        booking_id = next(BOOKING_COUNTER)
+        now = datetime.now()
+        time_str = now.strftime("%H:%M")
+        # 1. الحفظ في الإكسيل (بيتكتب في الخلفية)
+        booking_log.put([booking_id, user.full_name, now.strftime("%Y-%m-%d"), time_str, text])
         
         # 2. إعداد رسالة التنبيه للموظف والأدمين
         alert_msg = (f"🚨 **طلب حجز جديد**\n"
                      f"🎫 رقم الحجز: #{booking_id}\n"
                      f"👤 المريض: {user.full_name}\n"
                      f"📱 البيانات: {text}\n"
-                     f"⏰ الوقت: {datetime.now().strftime('%H:%M')}")
+                     f"⏰ الوقت: {time_str}")
         
-        # إرسال التنبيهات
-        targets = [ADMIN_ID, RECEPTIONIST_USER_ID]
+        # إرسال التنبيهات للأدمن والموظف مع بعض بدل واحد ورا التاني
+        targets = [t for t in (ADMIN_ID, RECEPTIONIST_USER_ID) if t]
+        results = await asyncio.gather(
+            *(context.bot.send_message(chat_id=t, text=alert_msg) for t in targets),
+            return_exceptions=True
+        )
+        for target, result in zip(targets, results):
+            if isinstance(result, Exception):
+                logger.error("Alert to %s failed: %s", target, result)
+
+    # 3. الرد على المريض
+    await update.message.chat.send_action(ChatAction.TYPING)
+    response = await engine.get_response(text, mode)
+    if booking_id is not None:
+        response = f"✅ تم استلام طلب الحجز، رقم الحجز: #{booking_id}\n\n{response}"
+    await update.message.reply_text(response)
+
+async def post_shutdown(app: Application):
+    # الحجوزات اللي لسه في الـ queue بتتكتب قبل ما الـ loop يقفل؛ flush_sync في atexit بيبقى احتياطي بس
+    await booking_log.close()
+    # الـ client بيتقفل على نفس الـ loop اللي اتفتحت عليه اتصالاته
+    await HTTP.aclose()
+
+def main():
+    app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        # مهلة القراءة لازم تبقى أكبر من الـ long poll (30 ثانية)
+        .get_updates_connect_timeout(10)
+        .get_updates_read_timeout(35)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_msg))
+    logger.info("🚀 Clinic bot is running")
+    # long polling: كل getUpdates بيفضل مفتوح لحد 30 ثانية لحد ما رسالة توصل
+    app.run_polling(allowed_updates=[Update.MESSAGE], timeout=30, poll_interval=0.0, bootstrap_retries=-1)
+
+if __name__ == "__main__":
+    main()